@@ -4,11 +4,17 @@ import os
 import sys
 import html
 import re
+import hashlib
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 import shutil
 
 from subpython.asset_copy import copy_local_assets
-from subpython.subset_fonts import run_subset_fonts
+from subpython.image_optimize import optimize_images
+from subpython.output_writer import OutputWriter
+from subpython.subset_fonts import run_subset_fonts, collect_texts_per_class
+from subpython.yaml_stream import iter_yaml_nodes
 
 try:
     import yaml
@@ -21,17 +27,13 @@ VOID_ELEMENTS = {
     "input", "link", "meta", "param", "source", "track", "wbr"
 }
 
-def load_yaml(path: Path):
-    with path.open(encoding="utf-8") as f:
-        data = yaml.safe_load(f)
-    if not isinstance(data, list):
-        raise ValueError(f"{path} はシーケンス（先頭が - の構造）である必要があります。")
-    return data
-
 def build_tree(nodes):
     indexed = list(enumerate(nodes))
     tag_map = {}
     id_map = {}
+    # (tag, id) → 候補。tag#id や {tag, id} 指定を全ノード走査せずに引く
+    tag_id_map = {}
+    id_all_map = {}
 
     for idx, node in indexed:
         tag = node.get("tag")
@@ -39,6 +41,12 @@ def build_tree(nodes):
         node_id = node.get("id")
         if isinstance(node_id, str):
             id_map[node_id] = idx
+        if node_id is not None:
+            try:
+                tag_id_map.setdefault((tag, node_id), []).append(idx)
+                id_all_map.setdefault(node_id, []).append(idx)
+            except TypeError:
+                pass
 
     children = {}
     parent_of = {}
@@ -46,7 +54,14 @@ def build_tree(nodes):
     def resolve_parent_spec(spec):
         if spec == "root":
             return None, []
-        if isinstance(spec, dict):
+        if isinstance(spec, dict) and "id" in spec and isinstance(spec["id"], str):
+            if "tag" in spec:
+                cand = tag_id_map.get((spec["tag"], spec["id"]), [])
+            else:
+                cand = id_all_map.get(spec["id"], [])
+        elif isinstance(spec, dict) and "tag" in spec and "id" not in spec:
+            cand = tag_map.get(spec["tag"], [])
+        elif isinstance(spec, dict):
             cand = []
             for idx, node in indexed:
                 match = True
@@ -63,10 +78,7 @@ def build_tree(nodes):
                 cand = [idx] if idx is not None else []
             elif "#" in spec:
                 tag_part, id_part = spec.split("#", 1)
-                cand = [
-                    idx for idx, node in indexed
-                    if node.get("tag") == tag_part and node.get("id") == id_part
-                ]
+                cand = tag_id_map.get((tag_part, id_part), [])
             else:
                 cand = tag_map.get(spec, [])
         else:
@@ -144,19 +156,36 @@ def assemble_html(indexed, children):
     return "\n".join(parts) + "\n"
 
 def adjust_asset_paths(html_text: str, out_html_path: Path, outdir: Path) -> str:
-    def repl(m):
-        attr, quote, orig = m.group(1), m.group(2), m.group(3)
+    def relocate(orig):
         if orig.startswith(("/", "http://", "https://", "data:")):
-            return m.group(0)
+            return orig
         target = (outdir / orig.lstrip("./")).resolve()
         try:
             rel = os.path.relpath(target, start=out_html_path.parent)
         except Exception:
             rel = orig
-        rel = rel.replace(os.sep, "/")
-        return f'{attr}={quote}{rel}{quote}'
+        return rel.replace(os.sep, "/")
+
+    def repl(m):
+        attr, quote, orig = m.group(1), m.group(2), m.group(3)
+        return f'{attr}={quote}{relocate(orig)}{quote}'
+
+    # srcset は「URL 幅記述子, URL 幅記述子, ...」なので URL 部分だけ置き換える
+    def repl_srcset(m):
+        attr, quote, value = m.group(1), m.group(2), m.group(3)
+        entries = []
+        for entry in value.split(","):
+            parts = entry.strip().split(None, 1)
+            if not parts:
+                continue
+            parts[0] = relocate(parts[0])
+            entries.append(" ".join(parts))
+        return f'{attr}={quote}{", ".join(entries)}{quote}'
+
     pattern = re.compile(r'(href|src)=(["\'])([^"\']+)(["\'])')
-    return pattern.sub(lambda m: repl(m), html_text)
+    html_text = pattern.sub(lambda m: repl(m), html_text)
+    srcset_pattern = re.compile(r'(srcset)=(["\'])([^"\']+)(["\'])')
+    return srcset_pattern.sub(lambda m: repl_srcset(m), html_text)
 
 def fix_page_links(html_text: str, yaml_to_output: dict, outdir: Path) -> str:
     valid_roots = set()
@@ -182,15 +211,16 @@ def fix_page_links(html_text: str, yaml_to_output: dict, outdir: Path) -> str:
 
 def gather_yaml_inputs(base_arg: str):
     p = Path(base_arg)
+    # _ で始まる YAML は include 用の断片とみなし、ページとしては出力しない
     if p.is_dir():
         yamls = list(p.rglob("*.yaml")) + list(p.rglob("*.yml"))
-        return sorted({x for x in yamls})
+        return sorted({x for x in yamls if not x.name.startswith("_")})
     else:
         result = [p]
         pages_dir = Path("pages")
         if pages_dir.is_dir():
             extra = list(pages_dir.rglob("*.yaml")) + list(pages_dir.rglob("*.yml"))
-            result.extend(extra)
+            result.extend(x for x in extra if not x.name.startswith("_"))
         return sorted({x for x in result})
 
 def compute_output_path(yaml_path: Path, outdir: Path) -> Path:
@@ -211,79 +241,72 @@ def copy_static_dirs(outdir: Path):
             dest = outdir / dirname
             shutil.copytree(src, dest, dirs_exist_ok=True)
 
-def process_single_yaml(yaml_path: Path, outdir: Path, yaml_to_output: dict):
+def add_class_texts(class_texts: dict, nodes):
+    # クラスごとの本文を出現順に積む（デバッグ CSV で実際のテキストを見られるように、集合にはしない）
+    for cls, text in collect_texts_per_class(nodes).items():
+        class_texts.setdefault(cls, []).append(text)
+
+def merged_font_nodes(class_texts: dict):
+    # クラスごとに本文をつないだノード列にして既存のサブセット処理へ渡す
+    return [{"class": cls, "text": "".join(texts)} for cls, texts in class_texts.items()]
+
+def process_single_yaml(yaml_path: Path, outdir: Path, yaml_to_output: dict, writer: OutputWriter,
+                        optimize_imgs: bool = True, class_texts: dict = None, image_pool=None):
+    # ノードを 1 つずつ読みながら、クラスごとの本文の集計と template の除去を済ませる
+    nodes = []
+    page_texts = {}
     try:
-        nodes = load_yaml(yaml_path)
+        for node in iter_yaml_nodes(yaml_path):
+            add_class_texts(page_texts, [node])
+            if node.get("parent") != "template":
+                nodes.append(node)
     except Exception as e:
         print(f"YAML 読み込みに失敗しました ({yaml_path}): {e}", file=sys.stderr)
-        return
+        # このページの前回の出力を古いものとして消さないようにする
+        writer.mark_failed()
+        return False
+    if class_texts is not None:
+        for cls, texts in page_texts.items():
+            class_texts.setdefault(cls, []).extend(texts)
 
-    # templateの除去
-    nodes = [node for node in nodes if node.get("parent") != "template"]
+    # img の WebP/AVIF・幅違いを生成し srcset/width/height を付ける
+    if optimize_imgs:
+        nodes = optimize_images(nodes, yaml_path.parent, outdir, pool=image_pool, writer=writer)
 
     indexed, children = build_tree(nodes)
     html_text = assemble_html(indexed, children)
     html_text = fix_page_links(html_text, yaml_to_output, outdir)
 
-    out_path = compute_output_path(yaml_path, outdir)
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-
+    out_path = yaml_to_output.get(yaml_path) or compute_output_path(yaml_path, outdir)
     html_text = adjust_asset_paths(html_text, out_path, outdir)
-    out_path.write_text(html_text, encoding="utf-8")
+    writer.write_text(out_path, html_text)
     print(f"HTML 出力: {out_path}")
 
     # asset_copy を YAML 親ディレクトリとルート両方で実行してローカル参照資産を拾う
     copy_local_assets(nodes, yaml_path.parent, outdir)
     copy_local_assets(nodes, Path("."), outdir)
+    return True
 
-def main():
-    import argparse
-
-    parser = argparse.ArgumentParser(description="YAML から HTML を生成し、dist 以下に出力する。pages/ 以下も継承し、相対パスを自動で調整する。")
-    parser.add_argument("yaml", nargs="?", default="index.yaml", help="入力 YAML ファイルかディレクトリ。pages/ 以下も自動で含む。")
-    parser.add_argument("--outdir", "-o", default="dist", help="出力先ディレクトリ（デフォルト: dist）")
-    args = parser.parse_args()
-
-    yaml_inputs = gather_yaml_inputs(args.yaml)
-    if not yaml_inputs:
-        sys.exit("処理対象の YAML が見つかりません。")
-
-    outdir = Path(args.outdir)
-    outdir.mkdir(parents=True, exist_ok=True)
-
-    # ルートの static ディレクトリを先にコピー
-    copy_static_dirs(outdir)
-
-    # 各 YAML の出力パスを事前に決めてマッピング
-    yaml_to_output = {}
-    for y in yaml_inputs:
-        yaml_to_output[y] = compute_output_path(y, outdir)
-
+def ordered_pages(yaml_inputs):
     # index.yaml を先に処理して共通資産を出す
+    pages = []
     root_index = Path("index.yaml")
     if root_index.exists():
-        process_single_yaml(root_index, outdir, yaml_to_output)
-
+        pages.append(root_index)
     for yaml_path in yaml_inputs:
         if not yaml_path.exists():
             print(f"スキップ: 存在しないファイル {yaml_path}", file=sys.stderr)
             continue
         if yaml_path.name.lower() in ("index.yaml", "index.yml") and yaml_path == root_index:
             continue
-        process_single_yaml(yaml_path, outdir, yaml_to_output)
-
-    # 全体の統合サブセットフォントを生成する
-    all_nodes = []
-    for y in yaml_inputs:
-        try:
-            nodes = load_yaml(y)
-        except Exception:
-            continue
-        all_nodes.extend(nodes)
+        pages.append(yaml_path)
+    return pages
 
+def build_merged_fonts(nodes, outdir: Path, writer: OutputWriter):
     merged_yaml = outdir / ".yahml_merged.yaml"
-    with merged_yaml.open("w", encoding="utf-8") as f:
-        yaml.safe_dump(all_nodes, f, allow_unicode=True, sort_keys=False)
+    writer.write_text(merged_yaml, yaml.safe_dump(nodes, allow_unicode=True, sort_keys=False))
+    # run_subset_fonts がディスクから読むので先に書き終えておく
+    writer.flush()
 
     try:
         run_subset_fonts(
@@ -296,5 +319,253 @@ def main():
     except Exception as e:
         print(f"統合サブセット生成でエラーが出ました: {e}", file=sys.stderr)
 
+def report_writes(counts: dict):
+    print(f"出力: 書き込み {counts['written']} 件, 変更なし {counts['skipped']} 件, 削除 {counts['removed']} 件")
+
+def open_image_pool(optimize_imgs: bool):
+    # 画像変換用のプロセスプールはページごとではなくビルド全体で 1 つ使う
+    return ProcessPoolExecutor() if optimize_imgs else nullcontext()
+
+def build_all(yaml_inputs, outdir: Path, optimize_imgs: bool = True):
+    outdir.mkdir(parents=True, exist_ok=True)
+
+    # ルートの static ディレクトリを先にコピー
+    copy_static_dirs(outdir)
+
+    # 各 YAML の出力パスを事前に決めてマッピング
+    yaml_to_output = {}
+    for y in yaml_inputs:
+        yaml_to_output[y] = compute_output_path(y, outdir)
+
+    # 全ノードを溜めずに、ページごとにクラス別の本文だけを集める
+    class_texts = {}
+    with OutputWriter(outdir) as writer, open_image_pool(optimize_imgs) as image_pool:
+        for yaml_path in ordered_pages(yaml_inputs):
+            process_single_yaml(yaml_path, outdir, yaml_to_output, writer, optimize_imgs, class_texts, image_pool)
+
+        # 全体の統合サブセットフォントを生成する
+        build_merged_fonts(merged_font_nodes(class_texts), outdir, writer)
+    report_writes(writer.counts)
+
+# ==== 分割ビルド（plan → shard × N → reduce） ====
+#
+# 1. plan   : 全ページの出力先マップを outdir/.yahml_plan.yaml に書く（軽い）
+# 2. shard  : 各シャードが担当ページだけを outdir/.yahml_shards/<番号>/ に描画し、
+#             クラスごとの使用文字を .yahml_codepoints.yaml に書く
+# 3. reduce : シャードの出力を outdir に集め、使用文字を統合して run_subset_fonts を一度だけ実行する
+#
+# 別マシンで shard を動かす場合は、plan ファイルを配布し、各マシンの
+# outdir/.yahml_shards/<番号>/ を reduce するマシンの同じ場所に集めてから reduce する。
+
+PLAN_NAME = ".yahml_plan.yaml"
+SHARDS_DIR_NAME = ".yahml_shards"
+CODEPOINTS_NAME = ".yahml_codepoints.yaml"
+
+def shard_dir_for(outdir: Path, shard_index: int) -> Path:
+    return outdir / SHARDS_DIR_NAME / str(shard_index)
+
+def write_build_plan(yaml_inputs, outdir: Path) -> Path:
+    outdir.mkdir(parents=True, exist_ok=True)
+    pages = []
+    for y in ordered_pages(yaml_inputs):
+        out_rel = compute_output_path(y, outdir).relative_to(outdir)
+        pages.append({"yaml": y.as_posix(), "output": out_rel.as_posix()})
+    plan_path = outdir / PLAN_NAME
+    with plan_path.open("w", encoding="utf-8") as f:
+        yaml.safe_dump({"pages": pages}, f, allow_unicode=True, sort_keys=False)
+    print(f"ビルド計画を出力: {plan_path} ({len(pages)} ページ)")
+    return plan_path
+
+def load_build_plan(outdir: Path):
+    plan_path = outdir / PLAN_NAME
+    if not plan_path.exists():
+        raise FileNotFoundError(f"ビルド計画が見つかりません: {plan_path}（先に --plan を実行してください）")
+    with plan_path.open(encoding="utf-8") as f:
+        plan = yaml.safe_load(f)
+    return [(Path(p["yaml"]), Path(p["output"])) for p in plan["pages"]]
+
+def plan_digest(outdir: Path) -> str:
+    # シャードと reduce が同じ計画を使ったかを確かめるためのハッシュ
+    return hashlib.sha256((outdir / PLAN_NAME).read_bytes()).hexdigest()
+
+def run_shard(outdir: Path, shard_index: int, shard_count: int, optimize_imgs: bool = True):
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f"シャード番号が範囲外です: {shard_index}/{shard_count}")
+    plan = load_build_plan(outdir)
+    digest = plan_digest(outdir)
+    shard_dir = shard_dir_for(outdir, shard_index)
+    if shard_dir.exists():
+        shutil.rmtree(shard_dir)
+    shard_dir.mkdir(parents=True)
+
+    # リンク解決は全ページ分の出力マップを使い、出力先だけシャードディレクトリに付け替える
+    yaml_to_output = {y: shard_dir / out_rel for y, out_rel in plan}
+
+    # シャードディレクトリは毎回作り直すので、古い出力の削除は reduce 側に任せる
+    class_texts = {}
+    failed_pages = []
+    with OutputWriter(shard_dir, manifest_name=None) as writer, open_image_pool(optimize_imgs) as image_pool:
+        for i, (yaml_path, _) in enumerate(plan):
+            if i % shard_count != shard_index:
+                continue
+            if not process_single_yaml(yaml_path, shard_dir, yaml_to_output, writer, optimize_imgs, class_texts, image_pool):
+                failed_pages.append(yaml_path.as_posix())
+
+        summary = {
+            "shard_index": shard_index,
+            "shard_count": shard_count,
+            "plan_digest": digest,
+            # reduce はこの一覧をマニフェストに載せ、失敗したページがあれば古い出力を消さない
+            "outputs": writer.tracked_outputs(),
+            "failed_pages": failed_pages,
+            "classes": {cls: "".join(sorted(set("".join(texts)))) for cls, texts in sorted(class_texts.items())},
+        }
+        writer.write_text(shard_dir / CODEPOINTS_NAME, yaml.safe_dump(summary, allow_unicode=True, sort_keys=False), track=False)
+    if writer.errors:
+        # reduce に進ませないよう、書き込みに失敗したシャードは終了コード 1 で終える
+        sys.exit(f"シャード {shard_index}/{shard_count} で書き込みエラーがありました: {shard_dir}")
+    print(f"シャード {shard_index}/{shard_count} 完了: {shard_dir}")
+
+def load_shard_summaries(outdir: Path, shard_count: int):
+    """全シャードの集計を読み、同じ計画・同じ分割数で作られたことを確かめる。
+
+    分割数を取り違えると一部のページが黙って抜け、古い出力として削除されてしまうので、
+    食い違いがあれば何も書き込む前に止める。
+    """
+    if shard_count < 1:
+        raise ValueError("--reduce には 1 以上を指定してください。")
+    digest = plan_digest(outdir)
+
+    shards_root = outdir / SHARDS_DIR_NAME
+    if shards_root.is_dir():
+        stray = sorted(
+            d.name for d in shards_root.iterdir()
+            if d.is_dir() and not (d.name.isdigit() and int(d.name) < shard_count)
+        )
+        if stray:
+            raise ValueError(f"分割数 {shard_count} に含まれないシャード出力があります: {', '.join(stray)}（--reduce の N を確認してください）")
+
+    summaries = []
+    for shard_index in range(shard_count):
+        summary_path = shard_dir_for(outdir, shard_index) / CODEPOINTS_NAME
+        if not summary_path.exists():
+            raise FileNotFoundError(f"シャード {shard_index} の出力がありません: {summary_path}")
+        with summary_path.open(encoding="utf-8") as f:
+            summary = yaml.safe_load(f) or {}
+        if summary.get("shard_count") != shard_count or summary.get("shard_index") != shard_index:
+            raise ValueError(
+                f"シャード {shard_index} は {summary.get('shard_index')}/{summary.get('shard_count')} として作られています"
+                f"（--reduce {shard_count} と一致しません）"
+            )
+        if summary.get("plan_digest") != digest:
+            raise ValueError(f"シャード {shard_index} は別のビルド計画で作られています。--plan からやり直してください。")
+        summaries.append(summary)
+    return summaries
+
+def run_reduce(outdir: Path, shard_count: int):
+    summaries = load_shard_summaries(outdir, shard_count)
+    copy_static_dirs(outdir)
+
+    class_codepoints = {}
+    with OutputWriter(outdir) as writer:
+        for shard_index, summary in enumerate(summaries):
+            for cls, chars in (summary.get("classes") or {}).items():
+                class_codepoints.setdefault(cls, set()).update(chars)
+            failed_pages = summary.get("failed_pages") or []
+            if failed_pages:
+                print(f"警告: シャード {shard_index} で出力できなかったページ: {', '.join(failed_pages)}", file=sys.stderr)
+                writer.mark_failed()
+            tracked = set(summary.get("outputs") or [])
+
+            shard_dir = shard_dir_for(outdir, shard_index)
+            summary_path = shard_dir / CODEPOINTS_NAME
+            for src in shard_dir.rglob("*"):
+                if not src.is_file() or src == summary_path:
+                    continue
+                # 古い出力として管理するのはシャードが管理していたもの（ページと生成画像）だけ。
+                # 参照資産は static ディレクトリと重なることがある
+                rel = src.relative_to(shard_dir)
+                writer.copy_file(src, outdir / rel, track=rel.as_posix() in tracked)
+
+        # シャードの集計は使用文字だけなので、文字をつないだノード列にして渡す
+        merged_nodes = [
+            {"class": cls, "text": "".join(sorted(chars))}
+            for cls, chars in sorted(class_codepoints.items())
+        ]
+        build_merged_fonts(merged_nodes, outdir, writer)
+    report_writes(writer.counts)
+    # 書き込みエラーや失敗したページがあれば、やり直せるようシャードの出力を残す
+    if writer.errors or writer.failed:
+        print(f"警告: 統合が完全ではないため {outdir / SHARDS_DIR_NAME} を残しました。", file=sys.stderr)
+        return
+    shutil.rmtree(outdir / SHARDS_DIR_NAME, ignore_errors=True)
+
+def run_local_shards(yaml_arg: str, outdir: Path, shard_count: int, optimize_imgs: bool = True):
+    import subprocess
+
+    write_build_plan(gather_yaml_inputs(yaml_arg), outdir)
+    cmd = [sys.executable, str(Path(__file__).resolve()), yaml_arg, "--outdir", str(outdir)]
+    if not optimize_imgs:
+        cmd.append("--no-optimize-images")
+    procs = [
+        subprocess.Popen(cmd + ["--shard", f"{i}/{shard_count}"])
+        for i in range(shard_count)
+    ]
+    failed = [i for i, p in enumerate(procs) if p.wait() != 0]
+    if failed:
+        sys.exit(f"シャードが失敗しました: {', '.join(map(str, failed))}")
+    run_reduce(outdir, shard_count)
+
+def parse_shard_spec(spec: str):
+    try:
+        index, count = (int(x) for x in spec.split("/", 1))
+    except ValueError:
+        raise ValueError(f"--shard は 番号/総数 の形式で指定してください: {spec}")
+    return index, count
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="YAML から HTML を生成し、dist 以下に出力する。pages/ 以下も継承し、相対パスを自動で調整する。")
+    parser.add_argument("yaml", nargs="?", default="index.yaml", help="入力 YAML ファイルかディレクトリ。pages/ 以下も自動で含む。")
+    parser.add_argument("--outdir", "-o", default="dist", help="出力先ディレクトリ（デフォルト: dist）")
+    parser.add_argument("--no-optimize-images", action="store_true", help="img 画像の WebP/AVIF 変換・リサイズを行わず、元画像のコピーだけにする")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--plan", action="store_true", help="分割ビルド: 全ページの出力先マップ (.yahml_plan.yaml) だけを書き出す")
+    mode.add_argument("--shard", metavar="K/N", help="分割ビルド: N 分割のうち K 番目（0 始まり）のページだけを描画する")
+    mode.add_argument("--reduce", type=int, metavar="N", help="分割ビルド: N 個のシャード出力を統合し、サブセットフォントを生成する")
+    mode.add_argument("--shards", type=int, metavar="N", help="分割ビルド: plan → N 個のシャードプロセス → reduce をこのマシンで実行する")
+    args = parser.parse_args()
+
+    outdir = Path(args.outdir)
+    optimize_imgs = not args.no_optimize_images
+
+    if args.shard:
+        try:
+            shard_index, shard_count = parse_shard_spec(args.shard)
+            run_shard(outdir, shard_index, shard_count, optimize_imgs)
+        except (ValueError, FileNotFoundError) as e:
+            sys.exit(str(e))
+        return
+    if args.reduce is not None:
+        try:
+            run_reduce(outdir, args.reduce)
+        except (ValueError, FileNotFoundError) as e:
+            sys.exit(str(e))
+        return
+
+    yaml_inputs = gather_yaml_inputs(args.yaml)
+    if not yaml_inputs:
+        sys.exit("処理対象の YAML が見つかりません。")
+
+    if args.plan:
+        write_build_plan(yaml_inputs, outdir)
+    elif args.shards is not None:
+        if args.shards < 1:
+            sys.exit("--shards には 1 以上を指定してください。")
+        run_local_shards(args.yaml, outdir, args.shards, optimize_imgs)
+    else:
+        build_all(yaml_inputs, outdir, optimize_imgs)
+
 if __name__ == "__main__":
     main()
@@ -27,6 +27,16 @@ def normalize_rel_path(rel: Path) -> Path:
         return Path(".")
     return Path(*parts)
 
+def find_source_file(rel_path: Path, yaml_dir: Path):
+    # 試すベースディレクトリの順番：まず YAML 親、その次にプロジェクトルート
+    tried = []
+    for base in (yaml_dir, Path(".")):
+        candidate = (base / rel_path).resolve()
+        tried.append(candidate)
+        if candidate.exists() and candidate.is_file():
+            return candidate, tried
+    return None, tried
+
 def copy_local_assets(nodes, yaml_dir: Path, outdir: Path):
     seen = set()
     for node in nodes:
@@ -36,16 +46,7 @@ def copy_local_assets(nodes, yaml_dir: Path, outdir: Path):
                 continue
             rel_path = Path(urlparse(val).path)
 
-            # 試すベースディレクトリの順番：まず YAML 親、その次にプロジェクトルート
-            src_path = None
-            tried = []
-            for base in (yaml_dir, Path(".")):
-                candidate = (base / rel_path).resolve()
-                tried.append(candidate)
-                if candidate.exists() and candidate.is_file():
-                    src_path = candidate
-                    break
-
+            src_path, tried = find_source_file(rel_path, yaml_dir)
             if src_path is None:
                 print(f"警告: 参照先ファイルが見つかりません: {val} (期待場所候補: {', '.join(str(p) for p in tried)})", file=sys.stderr)
                 continue
@@ -0,0 +1,273 @@
+# subpython/image_optimize.py
+
+from pathlib import Path
+from urllib.parse import urlparse
+import hashlib
+import posixpath
+import shutil
+import sys
+import os
+
+from subpython.asset_copy import is_local_reference, normalize_rel_path, find_source_file
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:
+    Image = None
+
+# 変換対象にする拡張子（gif/svg はアニメーション・ベクタなので対象外）
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+# 生成する横幅（元画像より小さいものだけ使い、元の幅は常に含める）
+DEFAULT_WIDTHS = (480, 960, 1600)
+
+# 形式名: (Pillow の format, MIME タイプ, quality)。<picture> 内では上から順に <source> を並べる
+VARIANT_FORMATS = {
+    "avif": ("AVIF", "image/avif", 50),
+    "webp": ("WEBP", "image/webp", 80),
+}
+
+# 内容アドレスのキャッシュ置き場（プロジェクトルート基準）
+DEFAULT_CACHE_DIR = Path(".yahml_cache") / "images"
+
+def available_formats():
+    if Image is None:
+        return []
+    return [name for name in VARIANT_FORMATS if features.check(name)]
+
+def file_digest(path: Path) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def read_image_size(path: Path):
+    # ヘッダだけ読む。EXIF の回転指定（5〜8）は縦横が入れ替わる
+    with Image.open(path) as img:
+        width, height = img.size
+        orientation = img.getexif().get(0x0112, 1)
+    if orientation in (5, 6, 7, 8):
+        width, height = height, width
+    return width, height
+
+def target_widths(orig_width: int, widths=DEFAULT_WIDTHS):
+    result = sorted({w for w in widths if w < orig_width})
+    result.append(orig_width)
+    return result
+
+def cache_path_for(cache_dir: Path, digest: str, width: int, fmt: str) -> Path:
+    _, _, quality = VARIANT_FORMATS[fmt]
+    return cache_dir / digest[:2] / f"{digest}-{width}w-q{quality}.{fmt}"
+
+def encode_variant(src_path: str, cache_path: str, width: int, fmt: str):
+    # ProcessPoolExecutor から呼ぶのでモジュール直下の関数にしておく
+    pil_format, _, quality = VARIANT_FORMATS[fmt]
+    with Image.open(src_path) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+        if width < img.width:
+            height = max(1, round(img.height * width / img.width))
+            img = img.resize((width, height), Image.LANCZOS)
+        dest = Path(cache_path)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dest.with_name(dest.name + f".{os.getpid()}.tmp")
+        try:
+            img.save(tmp, format=pil_format, quality=quality)
+            os.replace(tmp, dest)
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+    return cache_path
+
+def report_encode_error(job, e):
+    print(f"エラー: 画像変換に失敗しました: {job[0]} ({job[3]}, {job[2]}px) ({e})", file=sys.stderr)
+
+def run_encode_jobs(jobs, pool=None):
+    # pool はビルド全体で使い回す ProcessPoolExecutor。無ければこのプロセスで順に変換する
+    if not jobs:
+        return
+    if pool is None or len(jobs) == 1:
+        for job in jobs:
+            try:
+                encode_variant(*job)
+            except Exception as e:
+                report_encode_error(job, e)
+        return
+    futures = [(job, pool.submit(encode_variant, *job)) for job in jobs]
+    for job, fut in futures:
+        try:
+            fut.result()
+        except Exception as e:
+            report_encode_error(job, e)
+
+def copy_if_changed(src: Path, dest: Path):
+    # キャッシュ側の mtime を copy2 で引き継ぐので、サイズと mtime が同じなら同一とみなす
+    try:
+        s, d = src.stat(), dest.stat()
+        if s.st_size == d.st_size and s.st_mtime_ns == d.st_mtime_ns:
+            return
+    except FileNotFoundError:
+        pass
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copy2(src, dest)
+
+def parse_pixels(value):
+    # width/height 属性の値が整数ピクセルならその値、"50%" などなら None
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value.strip())
+    return None
+
+def fill_dimensions(node, orig_w: int, orig_h: int):
+    # 片方だけ指定されていれば縦横比を保ってもう片方を補う
+    has_w, has_h = "width" in node, "height" in node
+    if not has_w and not has_h:
+        node["width"] = orig_w
+        node["height"] = orig_h
+    elif has_w and not has_h:
+        w = parse_pixels(node["width"])
+        if w:
+            node["height"] = max(1, round(orig_h * w / orig_w))
+    elif has_h and not has_w:
+        h = parse_pixels(node["height"])
+        if h:
+            node["width"] = max(1, round(orig_w * h / orig_h))
+
+def variant_name(url_path: str, width: int, fmt: str) -> str:
+    # photo.jpg と photo.png が同じフォルダにあっても衝突しないよう元の拡張子を含める
+    p = Path(url_path)
+    return f"{p.stem}-{p.suffix.lstrip('.').lower()}-{width}w.{fmt}"
+
+def is_inside_picture(node, id_to_tag):
+    spec = node.get("parent")
+    if isinstance(spec, dict):
+        return spec.get("tag") == "picture"
+    if not isinstance(spec, str):
+        return False
+    if spec.startswith("#"):
+        return id_to_tag.get(spec[1:]) == "picture"
+    return spec.split("#", 1)[0] == "picture"
+
+def optimize_images(nodes, yaml_dir: Path, outdir: Path, widths=DEFAULT_WIDTHS,
+                    cache_dir: Path = DEFAULT_CACHE_DIR, pool=None, writer=None):
+    """img の src 画像から WebP/AVIF の幅違いを生成し、srcset/width/height を付けたノード列を返す。
+
+    <picture> 直下の img には形式ごとの <source> ノードを直前に挿入し、
+    それ以外の img には WebP（使えなければ他の形式）の srcset を付ける。
+    sizes は作者の指定、無ければ width のピクセル指定、それも無ければ 100vw を明示する。
+    元の src はフォールバックとしてそのまま残す。
+    writer（OutputWriter）を渡すと、生成した画像はその writer 経由で dist に書き込む。
+    """
+    formats = available_formats()
+    if not formats:
+        if Image is None:
+            print("警告: Pillow が見つからないため画像最適化をスキップします（pip install pillow）。", file=sys.stderr)
+        else:
+            print("警告: Pillow が WebP/AVIF に対応していないため画像最適化をスキップします。", file=sys.stderr)
+        return nodes
+
+    id_to_tag = {}
+    for node in nodes:
+        if isinstance(node.get("id"), str):
+            id_to_tag[node["id"]] = node.get("tag")
+
+    # 走査: 画像ごとに必要な形式・幅を決め、キャッシュに無いものだけジョブにする
+    plans = []
+    jobs = []
+    queued = set()
+    digests = {}
+    for node in nodes:
+        if node.get("tag") != "img":
+            continue
+        val = node.get("src")
+        if not val or not is_local_reference(val):
+            continue
+        url_path = urlparse(val).path
+        if not url_path.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        src_path, _ = find_source_file(Path(url_path), yaml_dir)
+        if src_path is None:
+            # 見つからない旨は copy_local_assets が警告する
+            continue
+
+        try:
+            if src_path not in digests:
+                digests[src_path] = (file_digest(src_path), read_image_size(src_path))
+        except Exception as e:
+            print(f"警告: 画像を読み込めませんでした: {src_path} ({e})", file=sys.stderr)
+            continue
+        digest, (orig_w, orig_h) = digests[src_path]
+
+        # 作者が width をピクセルで指定していればそれを表示幅とする（補った元画像の幅は使わない）。
+        # どちらも無ければブラウザの既定と同じ 100vw を明示する
+        sizes = node.get("sizes")
+        authored_w = parse_pixels(node.get("width"))
+        if not sizes:
+            sizes = f"{authored_w}px" if authored_w else "100vw"
+
+        fill_dimensions(node, orig_w, orig_h)
+
+        in_picture = is_inside_picture(node, id_to_tag)
+        if not in_picture and "srcset" in node:
+            continue
+        node_formats = formats if in_picture else [("webp" if "webp" in formats else formats[0])]
+        node_widths = target_widths(orig_w, widths)
+
+        for fmt in node_formats:
+            for w in node_widths:
+                cached = cache_path_for(cache_dir, digest, w, fmt)
+                if not cached.exists() and cached not in queued:
+                    queued.add(cached)
+                    jobs.append((str(src_path), str(cached), w, fmt))
+        plans.append((node, url_path, digest, sizes, in_picture, node_formats, node_widths))
+
+    run_encode_jobs(jobs, pool)
+
+    # 出力: キャッシュから dist へ配置し、ノードに属性を付ける
+    source_nodes_for = {}
+    for node, url_path, digest, sizes, in_picture, node_formats, node_widths in plans:
+        dest_dir = normalize_rel_path(Path(url_path)).parent
+        url_dir = posixpath.dirname(url_path)
+
+        srcsets = {}
+        for fmt in node_formats:
+            entries = []
+            for w in node_widths:
+                cached = cache_path_for(cache_dir, digest, w, fmt)
+                if not cached.exists():
+                    continue
+                name = variant_name(url_path, w, fmt)
+                if writer is not None:
+                    writer.copy_file(cached, outdir / dest_dir / name)
+                else:
+                    copy_if_changed(cached, outdir / dest_dir / name)
+                url = posixpath.join(url_dir, name)
+                entries.append(f"{url} {w}w")
+            if entries:
+                srcsets[fmt] = ", ".join(entries)
+
+        if not srcsets:
+            continue
+        if in_picture:
+            sources = []
+            for fmt, srcset in srcsets.items():
+                source = {"tag": "source", "type": VARIANT_FORMATS[fmt][1], "srcset": srcset, "sizes": sizes}
+                source["parent"] = node["parent"]
+                sources.append(source)
+            source_nodes_for[id(node)] = sources
+        else:
+            node["srcset"] = next(iter(srcsets.values()))
+            node.setdefault("sizes", sizes)
+
+    if not source_nodes_for:
+        return nodes
+    result = []
+    for node in nodes:
+        result.extend(source_nodes_for.get(id(node), []))
+        result.append(node)
+    return result
@@ -0,0 +1,149 @@
+# subpython/output_writer.py
+
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import sys
+import os
+
+DEFAULT_MANIFEST_NAME = ".yahml_manifest"
+
+class OutputWriter:
+    """dist への書き込みをまとめて扱う。
+
+    - 既存ファイルと中身が同じなら書かない（mtime を変えない）
+    - 一時ファイルに書いてから os.replace で置き換える（途中で落ちても壊れたファイルを残さない）
+    - 書き込みはスレッドプールで行い、描画とディスク I/O を重ねる
+    - manifest_name を指定すると、前回書いたが今回書かなかったファイルを close 時に削除する
+      （失敗したビルド、mark_failed されたページ、書き込みエラーがあったときは削除しない）
+    """
+
+    def __init__(self, outdir: Path, max_workers=None, manifest_name=DEFAULT_MANIFEST_NAME):
+        self.outdir = Path(outdir)
+        self.manifest_name = manifest_name
+        self.counts = {"written": 0, "skipped": 0, "removed": 0}
+        self.errors = []
+        self.failed = False
+        self._outputs = set()
+        self._pending = []
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="yahml-writer")
+
+    # track=False のファイルはマニフェストに載せない（古い出力として削除されることもない）
+    def write_text(self, path: Path, text: str, encoding: str = "utf-8", track: bool = True):
+        self.write_bytes(path, text.encode(encoding), track)
+
+    def write_bytes(self, path: Path, data: bytes, track: bool = True):
+        path = Path(path)
+        with self._lock:
+            if track:
+                self._outputs.add(path.resolve())
+            self._pending.append(self._pool.submit(self._write, path, data))
+
+    def copy_file(self, src: Path, path: Path, track: bool = True):
+        # 読み込みもワーカー側で行い、大量のファイルをメモリに溜めない
+        path = Path(path)
+        with self._lock:
+            if track:
+                self._outputs.add(path.resolve())
+            self._pending.append(self._pool.submit(lambda: self._write(path, Path(src).read_bytes())))
+
+    def tracked_outputs(self):
+        # マニフェストに載る（古い出力として管理する）ファイルの outdir からの相対パス
+        outdir_resolved = self.outdir.resolve()
+        with self._lock:
+            outputs = list(self._outputs)
+        return sorted(p.relative_to(outdir_resolved).as_posix() for p in outputs if p.is_relative_to(outdir_resolved))
+
+    def mark_failed(self):
+        # 出力できなかったページがある。前回の出力が古いのか判断できないので削除しない
+        self.failed = True
+
+    def flush(self):
+        # ここまでに積んだ書き込みの完了を待つ（書いた直後のファイルを読む処理の前に呼ぶ）
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for fut in pending:
+            fut.result()
+
+    def close(self):
+        self.flush()
+        self._pool.shutdown(wait=True)
+        if self.manifest_name and not self.errors and not self.failed:
+            self._remove_stale()
+        elif self.manifest_name and self.failed:
+            print("警告: 失敗したページがあるため、古い出力の削除を行いませんでした。", file=sys.stderr)
+        for path, e in self.errors:
+            print(f"エラー: ファイルを書き込めませんでした: {path} ({e})", file=sys.stderr)
+        return dict(self.counts)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            # 失敗したビルドでは古いファイルを消さない
+            self.failed = True
+        self.close()
+        return False
+
+    def _count(self, key: str, n: int = 1):
+        with self._lock:
+            self.counts[key] += n
+
+    def _write(self, path: Path, data: bytes):
+        try:
+            if _same_content(path, data):
+                self._count("skipped")
+                return
+            atomic_write_bytes(path, data)
+            self._count("written")
+        except Exception as e:
+            with self._lock:
+                self.errors.append((path, e))
+
+    def _remove_stale(self):
+        manifest = self.outdir / self.manifest_name
+        outdir_resolved = self.outdir.resolve()
+        previous = []
+        if manifest.exists():
+            previous = manifest.read_text(encoding="utf-8").splitlines()
+
+        for rel in previous:
+            if not rel:
+                continue
+            path = (outdir_resolved / rel).resolve()
+            # outdir の外や今回出力したファイルは触らない
+            if path in self._outputs or not path.is_relative_to(outdir_resolved):
+                continue
+            if path.is_file():
+                try:
+                    path.unlink()
+                    self.counts["removed"] += 1
+                except OSError as e:
+                    print(f"警告: 古い出力を削除できませんでした: {path} ({e})", file=sys.stderr)
+
+        current = self.tracked_outputs()
+        data = ("\n".join(current) + "\n").encode("utf-8")
+        if not _same_content(manifest, data):
+            atomic_write_bytes(manifest, data)
+
+def atomic_write_bytes(path: Path, data: bytes):
+    # 同じディレクトリに一時ファイルを作り、os.replace で一度に置き換える
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with tmp.open("wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+def _same_content(path: Path, data: bytes) -> bool:
+    try:
+        if path.stat().st_size != len(data):
+            return False
+        return path.read_bytes() == data
+    except FileNotFoundError:
+        return False
@@ -2,9 +2,13 @@
 
 import sys
 import os
+import io
+import mmap
+import hashlib
 from pathlib import Path
 import yaml
 import tinycss2
+import fontTools
 from fontTools import ttLib
 from fontTools.subset import Subsetter, Options
 import csv
@@ -126,27 +130,198 @@ def build_family_codepoints(class_to_family, class_texts):
         family_codepoints[family] = codepoints
     return family_codepoints
 
+# サブセット結果のキャッシュ置き場（元フォントの内容ハッシュと文字集合で引く）
+FONT_CACHE_DIR = Path(".yahml_cache") / "fonts"
+
+# サブセットの設定（Options）や保存形式を変えたら上げる
+FONT_CACHE_VERSION = 1
+
+class _MappedReader(io.RawIOBase):
+    # 共有している mmap を、TTFont ごとに独立した読み位置で読むためのラッパ
+    def __init__(self, buf):
+        self._view = memoryview(buf)
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), len(self._view) - self._pos)
+        b[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._view.release()
+        super().close()
+
+class SourceFont:
+    """元フォント 1 ファイル分。
+
+    ファイルは最初に必要になったときに mmap で開き、同じフォントを指すすべての
+    @font-face で共有する。cmap と、文字集合ごとのサブセット結果も使い回す。
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.stat_key = _stat_key(path)
+        self._file = None
+        self._mmap = None
+        self._digest = None
+        self._cmap = None
+        self._subsets = {}
+
+    def buffer(self):
+        if self._mmap is None:
+            self._file = self.path.open("rb")
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def open_font(self):
+        # lazy=True でテーブルは読まれたときに初めて解析される
+        return ttLib.TTFont(io.BufferedReader(_MappedReader(self.buffer())), lazy=True)
+
+    def digest(self):
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.buffer()).hexdigest()
+        return self._digest
+
+    def supported_codepoints(self):
+        # getBestCmap には異体字セレクタが入らないので、format 14 の uvsDict からも拾う
+        if self._cmap is None:
+            font = self.open_font()
+            try:
+                supported = set(font.getBestCmap() or {})
+                if "cmap" in font:
+                    for table in font["cmap"].tables:
+                        if table.format == 14:
+                            supported.update(table.uvsDict)
+            finally:
+                font.close()
+            self._cmap = frozenset(supported)
+        return self._cmap
+
+    def subset_bytes(self, codepoints: frozenset, cache_dir: Path = FONT_CACHE_DIR):
+        # 同じビルド内 → メモリ、過去のビルド → ディスクキャッシュ、どちらも無ければサブセットする
+        cached = self._subsets.get(codepoints)
+        if cached is not None:
+            return cached
+
+        # fontTools を更新すると同じ入力でも出力が変わりうるので、そのバージョンもキーに含める
+        key_source = f"{FONT_CACHE_VERSION}:{fontTools.version}:" + ",".join(map(str, sorted(codepoints)))
+        text_key = hashlib.sha256(key_source.encode("ascii")).hexdigest()
+        cache_path = cache_dir / f"{self.digest()}-{text_key[:32]}.woff2"
+        if cache_path.exists():
+            data = cache_path.read_bytes()
+        else:
+            data = self._subset(codepoints)
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = cache_path.with_name(cache_path.name + f".{os.getpid()}.tmp")
+            tmp.write_bytes(data)
+            os.replace(tmp, cache_path)
+        self._subsets[codepoints] = data
+        return data
+
+    def _subset(self, codepoints: frozenset):
+        options = Options()
+        options.flavor = "woff2"
+        options.with_zopfli = False
+        subsetter = Subsetter(options=options)
+        subsetter.populate(unicodes=sorted(codepoints))
+        font = self.open_font()
+        try:
+            subsetter.subset(font)
+            font.flavor = "woff2"
+            out = io.BytesIO()
+            font.save(out)
+        finally:
+            font.close()
+        return out.getvalue()
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap = None
+            self._file = None
+
+def is_variation_selector(cp: int) -> bool:
+    return 0xFE00 <= cp <= 0xFE0F or 0xE0100 <= cp <= 0xE01EF
+
+def _stat_key(path: Path):
+    st = path.stat()
+    return (st.st_size, st.st_mtime_ns)
+
+# 解決済みパス → SourceFont。ファイルが更新されていれば開き直す
+_SOURCE_FONTS = {}
+
+def get_source_font(path: Path) -> SourceFont:
+    path = path.resolve()
+    font = _SOURCE_FONTS.get(path)
+    if font is not None and font.stat_key != _stat_key(path):
+        font.close()
+        font = None
+    if font is None:
+        font = SourceFont(path)
+        _SOURCE_FONTS[path] = font
+    return font
+
+def close_source_fonts():
+    # 開いたままの mmap とファイルを閉じる（run_subset_fonts の最後に呼ぶ）
+    for font in _SOURCE_FONTS.values():
+        font.close()
+    _SOURCE_FONTS.clear()
+
 def subset_font(src_path: Path, dest_path: Path, codepoints_set: set):
     if not src_path.exists():
         print(f"エラー: 元フォントが見つかりません: {src_path}", file=sys.stderr)
         return False
     try:
-        font = ttLib.TTFont(str(src_path))
+        source = get_source_font(src_path)
+        supported = source.supported_codepoints()
     except Exception as e:
         print(f"フォント読み込み失敗: {src_path} ({e})", file=sys.stderr)
         return False
 
-    options = Options()
-    options.flavor = "woff2"
-    options.with_zopfli = False
-    subsetter = Subsetter(options=options)
-    text = "".join(sorted(codepoints_set))
-    subsetter.populate(text=text)
-    subsetter.subset(font)
-    dest_path.parent.mkdir(parents=True, exist_ok=True)
-    font.flavor = "woff2"
+    # フォントに無い文字はサブセットしても出てこないので、キャッシュキーからも外す。
+    # 異体字セレクタは IVS のグリフを残すのに要るので、フォントが対応していれば残す
+    codepoints = frozenset(ord(c) for c in codepoints_set if ord(c) in supported)
+    missing = sum(
+        1 for c in codepoints_set
+        if c.isprintable() and ord(c) not in supported and not is_variation_selector(ord(c))
+    )
+    if missing:
+        print(f"警告: {src_path.name} に無い文字が {missing} 文字あります。", file=sys.stderr)
+
     try:
-        font.save(str(dest_path))
+        data = source.subset_bytes(codepoints)
+    except Exception as e:
+        print(f"サブセット生成失敗: {src_path} ({e})", file=sys.stderr)
+        return False
+
+    # 中身が同じなら書き換えない（mtime を保つ）
+    try:
+        if dest_path.exists() and dest_path.read_bytes() == data:
+            print(f"サブセット変更なし: {dest_path} (元: {src_path}, {len(codepoints_set)}文字)", file=sys.stderr)
+            return True
+        dest_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dest_path.with_name(dest_path.name + f".{os.getpid()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, dest_path)
     except Exception as e:
         print(f"サブセットフォント保存失敗: {dest_path} ({e})", file=sys.stderr)
         return False
@@ -218,23 +393,26 @@ def run_subset_fonts(css_path: str, index_yaml: str, dist_dir: str, fonts_source
 
     family_codepoints = build_family_codepoints(class_to_family, class_texts)
 
-    for family, codepoints in family_codepoints.items():
-        face = font_face_map.get(family)
-        if not face:
-            print(f"警告: @font-face 定義が見つかりません: font-family '{family}' を使うクラスがあるが対応する @font-face がありません。", file=sys.stderr)
-            continue
-        subset_source_name = face.get("subset_source")
-        subset_output_rel = face.get("subset_output")
-        if not subset_source_name:
-            print(f"警告: --subset-source がありません: font-family '{family}' の @font-face に元フォント指定がないためスキップします。", file=sys.stderr)
-            continue
-        if not subset_output_rel:
-            print(f"警告: src (出力先) がありません: font-family '{family}' の @font-face に src がないためスキップします。", file=sys.stderr)
-            continue
+    try:
+        for family, codepoints in family_codepoints.items():
+            face = font_face_map.get(family)
+            if not face:
+                print(f"警告: @font-face 定義が見つかりません: font-family '{family}' を使うクラスがあるが対応する @font-face がありません。", file=sys.stderr)
+                continue
+            subset_source_name = face.get("subset_source")
+            subset_output_rel = face.get("subset_output")
+            if not subset_source_name:
+                print(f"警告: --subset-source がありません: font-family '{family}' の @font-face に元フォント指定がないためスキップします。", file=sys.stderr)
+                continue
+            if not subset_output_rel:
+                print(f"警告: src (出力先) がありません: font-family '{family}' の @font-face に src がないためスキップします。", file=sys.stderr)
+                continue
 
-        src_path = (fonts_source_dir / subset_source_name).resolve()
-        dest_path = (dist_dir / subset_output_rel).resolve()
-        subset_font(src_path, dest_path, codepoints)
+            src_path = (fonts_source_dir / subset_source_name).resolve()
+            dest_path = (dist_dir / subset_output_rel).resolve()
+            subset_font(src_path, dest_path, codepoints)
+    finally:
+        close_source_fonts()
 
     # CSV 出力（完了後の状態を人が見られるように）
     write_debug_csvs(dist_dir, class_table, family_codepoints, font_face_map)
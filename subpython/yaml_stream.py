@@ -0,0 +1,110 @@
+# subpython/yaml_stream.py
+
+from pathlib import Path
+import hashlib
+import pickle
+import sys
+import os
+
+import yaml
+
+# 断片ファイル（include で読み込む YAML）のキャッシュ置き場
+DEFAULT_CACHE_DIR = Path(".yahml_cache") / "fragments"
+
+# キャッシュの形式を変えたら上げる
+CACHE_VERSION = 1
+
+def iter_yaml_items(path: Path):
+    """トップレベルがシーケンスの YAML を、要素ごとに構築して順に返す。
+
+    イベント列から要素 1 つ分のノードだけを組み立てて Python オブジェクトにするので、
+    ドキュメント全体のノードグラフを保持しない。アンカーは後の要素のエイリアスから
+    参照できるよう残る。
+    """
+    with path.open(encoding="utf-8") as f:
+        loader = yaml.SafeLoader(f)
+        try:
+            loader.get_event()  # StreamStart
+            if loader.check_event(yaml.StreamEndEvent):
+                raise ValueError(f"{path} はシーケンス（先頭が - の構造）である必要があります。")
+            loader.get_event()  # DocumentStart
+            if not loader.check_event(yaml.SequenceStartEvent):
+                raise ValueError(f"{path} はシーケンス（先頭が - の構造）である必要があります。")
+            loader.get_event()
+            while not loader.check_event(yaml.SequenceEndEvent):
+                node = loader.compose_node(None, None)
+                # construct_document は要素ごとに構築済みオブジェクトの表を捨てる
+                yield loader.construct_document(node)
+            loader.get_event()  # SequenceEnd
+            loader.get_event()  # DocumentEnd
+            # safe_load と同じく、2 つ目以降のドキュメントがあればエラーにする
+            if not loader.check_event(yaml.StreamEndEvent):
+                event = loader.peek_event()
+                raise ValueError(f"{path} に複数のドキュメントがあります（{event.start_mark}）。1 ファイル 1 ドキュメントにしてください。")
+        finally:
+            loader.dispose()
+
+def is_include(item) -> bool:
+    return isinstance(item, dict) and "include" in item and "tag" not in item
+
+def include_targets(item):
+    value = item["include"]
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, list) and all(isinstance(v, str) for v in value):
+        return value
+    raise ValueError(f"include にはファイルパスかその一覧を指定してください: {item}")
+
+def resolve_include(target: str, base_dir: Path) -> Path:
+    # 探す順番：まず読み込み元 YAML の親、その次にプロジェクトルート
+    for base in (base_dir, Path(".")):
+        candidate = (base / target).resolve()
+        if candidate.is_file():
+            return candidate
+    raise FileNotFoundError(f"include 先が見つかりません: {target}（{base_dir} から）")
+
+def load_fragment(path: Path, cache_dir: Path = DEFAULT_CACHE_DIR):
+    """断片ファイルの要素一覧を返す。更新されていなければディスクキャッシュから読む。
+
+    include はここでは展開しない（入れ子の断片もそれぞれ独立にキャッシュされる）。
+    """
+    st = path.stat()
+    stat_key = (CACHE_VERSION, st.st_size, st.st_mtime_ns)
+    cache_path = cache_dir / (hashlib.sha256(str(path).encode("utf-8")).hexdigest() + ".pickle")
+    try:
+        with cache_path.open("rb") as f:
+            cached_key, items = pickle.load(f)
+        if cached_key == stat_key:
+            return items
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"警告: 断片キャッシュを読めませんでした: {cache_path} ({e})", file=sys.stderr)
+
+    items = list(iter_yaml_items(path))
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cache_path.with_name(cache_path.name + f".{os.getpid()}.tmp")
+        with tmp.open("wb") as f:
+            pickle.dump((stat_key, items), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache_path)
+    except Exception as e:
+        print(f"警告: 断片キャッシュを書き込めませんでした: {cache_path} ({e})", file=sys.stderr)
+    return items
+
+def iter_yaml_nodes(path: Path, cache_dir: Path = DEFAULT_CACHE_DIR, _stack=()):
+    """ページ YAML のノードを順に返す。`- include: 断片.yaml` の要素はその断片のノードに置き換える。"""
+    resolved = Path(path).resolve()
+    if resolved in _stack:
+        chain = " -> ".join(str(p) for p in _stack + (resolved,))
+        raise ValueError(f"include が循環しています: {chain}")
+
+    # ページ本体はストリームで読み、include された断片はキャッシュ経由で読む
+    items = load_fragment(resolved, cache_dir) if _stack else iter_yaml_items(Path(path))
+    for item in items:
+        if not is_include(item):
+            yield item
+            continue
+        for target in include_targets(item):
+            fragment = resolve_include(target, resolved.parent)
+            yield from iter_yaml_nodes(fragment, cache_dir, _stack + (resolved,))